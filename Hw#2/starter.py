@@ -91,7 +91,7 @@ def attention(q, k, v, d_k, mask=None, dropout=None):
     if mask is not None:
         # mask = mask.unsqueeze(1)
         mask = mask.expand(q.size(0), q.size(1), -1, -1)
-        scores = scores.masked_fill(mask == 0, 1e-9)
+        scores = scores.masked_fill(mask == 0, float('-inf'))
     
     scores = F.softmax(scores, dim=-1)
     
@@ -365,7 +365,8 @@ def collate_fn(batch):
     return inputs, targets
 
 def no_peak_mask(size):
-    mask = torch.triu(torch.ones(size, size) * float('-inf'), diagonal=1)
+    # True where a position may attend, i.e. itself and earlier tokens
+    mask = torch.tril(torch.ones(size, size, dtype=torch.bool))
     return mask
 
 import matplotlib.pyplot as plt
@@ -395,13 +396,14 @@ def plot_metrics(training_losses, validation_losses, training_perplexities, vali
     print(f"Plot saved as {filename}")
 #############################
 
-def validate(model, valid_dataloader, device):
+def validate(model, valid_dataloader, opt):
     model.eval()
+    device = opt.device
     total_loss = 0
     with torch.no_grad():
         for input_text, target_text in valid_dataloader:
             input_text, target_text = input_text.to(device), target_text.to(device)
-            input_mask = no_peak_mask(input_text.size(1)).to(device)
+            input_mask = opt.causal_mask[:input_text.size(1), :input_text.size(1)]
             output = model(input_text, input_mask)
             loss = F.cross_entropy(output.view(-1, output.size(-1)), target_text.view(-1), ignore_index=-100)
             total_loss += loss.item()
@@ -416,7 +418,7 @@ def test(model, opt, test_dataloader):
     with torch.no_grad():
         for input_text, target_text in test_dataloader:
             input_text, target_text = input_text.to(device), target_text.to(device)
-            input_mask = no_peak_mask(input_text.size(1)).to(device)
+            input_mask = opt.causal_mask[:input_text.size(1), :input_text.size(1)]
             output = model(input_text, input_mask)
             loss = F.cross_entropy(output.view(-1, output.size(-1)), target_text.view(-1), ignore_index=-100)
             total_loss += loss.item()
@@ -460,7 +462,7 @@ def train_model(model, opt, train_dataloader, valid_dataloader):
 
         for input_text, target_text in train_dataloader:
             input_text, target_text = input_text.to(device), target_text.to(device)
-            input_mask = no_peak_mask(input_text.size(1)).to(device)
+            input_mask = opt.causal_mask[:input_text.size(1), :input_text.size(1)]
             output = model(input_text, input_mask)
             loss = F.cross_entropy(output.view(-1, output.size(-1)), target_text.view(-1), ignore_index=-100)
             optimizer.zero_grad()
@@ -473,7 +475,7 @@ def train_model(model, opt, train_dataloader, valid_dataloader):
 
         avg_tl = total_tl / len(train_dataloader)
         train_perplexity = math.exp(avg_tl)
-        avg_vl, valid_perplexity = validate(model, valid_dataloader, device)
+        avg_vl, valid_perplexity = validate(model, valid_dataloader, opt)
 
         train_losses.append(avg_tl)
         valid_losses.append(avg_vl)
@@ -529,6 +531,8 @@ def main():
     if opt.device == 0:
         assert torch.cuda.is_available()
     opt.device = torch.device("cuda:0")
+    # build the causal mask once on the device and slice it per batch
+    opt.causal_mask = no_peak_mask(opt.seqlen).to(opt.device)
     
     time_name = time.strftime("%y%m%d_%H%M%S")
     opt.time_name = time_name
@@ -8,24 +8,23 @@ import time
 import copy
 import math
 import pickle
+import itertools
 
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
-from torch.autograd import Variable
 from transformers import GPT2TokenizerFast
 from torch.utils.data import DataLoader, Dataset
-from torch.nn.utils.rnn import pad_sequence
+from torch.utils.checkpoint import checkpoint
 import matplotlib.pyplot as plt
 
 def read_corpus(filename,tokenizer):
-    seq = []
     with open(filename,'rt') as f:
-        for line in f:
-            line = line.replace('\n','')
-            tokens = tokenizer(line)
-            for t in tokens['input_ids']:
-                seq.append(t)
+        lines = [line.replace('\n','') for line in f]
+    # tokenize all lines in one batched call and flatten into a single
+    # int32 array (the GPT-2 vocab fits and it is half the size of int64)
+    ids = tokenizer(lines)['input_ids']
+    seq = np.fromiter(itertools.chain.from_iterable(ids), dtype=np.int32)
     return(seq)
 
 class Embedder(nn.Module):
@@ -34,7 +33,7 @@ class Embedder(nn.Module):
         self.d_model = d_model
         self.embed = nn.Embedding(vocab_size, d_model)
     def forward(self, x):
-        return self.embed(x.int())
+        return self.embed(x)
 
 class PositionalEncoder(nn.Module):
     def __init__(self, d_model, max_seq_len = 4096, dropout = 0.1):
@@ -44,12 +43,11 @@ class PositionalEncoder(nn.Module):
         # create constant 'pe' matrix with values dependant on 
         # pos and i
         pe = torch.zeros(max_seq_len, d_model)
-        for pos in range(max_seq_len):
-            for i in range(0, d_model, 2):
-                pe[pos, i] = \
-                math.sin(pos / (10000 ** ((2 * i)/d_model)))
-                pe[pos, i + 1] = \
-                math.cos(pos / (10000 ** ((2 * (i + 1))/d_model)))
+        # computed in float64 to match the values of the math.sin/cos version
+        pos = torch.arange(max_seq_len, dtype=torch.float64).unsqueeze(1)
+        i = torch.arange(0, d_model, 2, dtype=torch.float64)
+        pe[:, 0::2] = torch.sin(pos / (10000 ** ((2 * i)/d_model)))
+        pe[:, 1::2] = torch.cos(pos / (10000 ** ((2 * (i + 1))/d_model)))
         pe = pe.unsqueeze(0)
         self.register_buffer('pe', pe)
     
@@ -58,46 +56,10 @@ class PositionalEncoder(nn.Module):
         x = x * math.sqrt(self.d_model)
         #add constant to embedding
         seq_len = x.size(1)
-        pe = Variable(self.pe[:,:seq_len], requires_grad=False)
-        if x.is_cuda:
-            pe.cuda()
-        x = x + pe
+        # 'pe' is a buffer, so it already lives on the model's device
+        x = x + self.pe[:,:seq_len]
         return self.dropout(x)
 
-class Norm(nn.Module):
-    def __init__(self, d_model, eps = 1e-6):
-        super().__init__()
-    
-        self.size = d_model
-        
-        # create two learnable parameters to calibrate normalisation
-        self.alpha = nn.Parameter(torch.ones(self.size))
-        self.bias = nn.Parameter(torch.zeros(self.size))
-        
-        self.eps = eps
-    
-    def forward(self, x):
-        norm = self.alpha * (x - x.mean(dim=-1, keepdim=True)) \
-        / (x.std(dim=-1, keepdim=True) + self.eps) + self.bias
-        return norm
-
-def attention(q, k, v, d_k, mask=None, dropout=None):
-    
-    scores = torch.matmul(q, k.transpose(-2, -1)) /  math.sqrt(d_k)
-    
-    if mask is not None:
-        # mask = mask.unsqueeze(1)
-        mask = mask.expand(q.size(0), q.size(1), -1, -1)
-        scores = scores.masked_fill(mask == 0, 1e-9)
-    
-    scores = F.softmax(scores, dim=-1)
-    
-    if dropout is not None:
-        scores = dropout(scores)
-        
-    output = torch.matmul(scores, v)
-    return output
-
 class MultiHeadAttention(nn.Module):
     def __init__(self, heads, d_model, dropout = 0.1):
         super().__init__()
@@ -106,32 +68,30 @@ class MultiHeadAttention(nn.Module):
         self.d_k = d_model // heads
         self.h = heads
         
-        self.q_linear = nn.Linear(d_model, d_model)
-        self.v_linear = nn.Linear(d_model, d_model)
-        self.k_linear = nn.Linear(d_model, d_model)
+        # q, k and v projections packed into a single linear layer
+        self.qkv_linear = nn.Linear(d_model, 3 * d_model)
         
         self.dropout = nn.Dropout(dropout)
         self.out = nn.Linear(d_model, d_model)
     
-    def forward(self, q, k, v, mask=None):
-        
-        bs = q.size(0)
+    def forward(self, x, mask=None, is_causal=False):
         
-        # perform linear operation and split into N heads
-        k = self.k_linear(k).view(bs, -1, self.h, self.d_k)
-        q = self.q_linear(q).view(bs, -1, self.h, self.d_k)
-        v = self.v_linear(v).view(bs, -1, self.h, self.d_k)
+        bs = x.size(0)
         
-        # transpose to get dimensions bs * N * sl * d_model
-        k = k.transpose(1,2)
-        q = q.transpose(1,2)
-        v = v.transpose(1,2)
-
-        # calculate attention using function we will define next
-        scores = attention(q, k, v, self.d_k, mask, self.dropout)
-        # concatenate heads and put through final linear layer
-        concat = scores.transpose(1,2).contiguous()\
-        .view(bs, -1, self.d_model)
+        # perform one linear operation for q, k and v and split into N heads,
+        # permuting to get dimensions 3 * bs * N * sl * d_k
+        qkv = self.qkv_linear(x).view(bs, -1, 3, self.h, self.d_k)
+        qkv = qkv.permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+
+        # fused scaled dot product attention, causal masking is done
+        # inside the kernel so no S x S mask is built
+        dropout_p = self.dropout.p if self.training else 0.0
+        scores = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, \
+        dropout_p=dropout_p, is_causal=is_causal)
+        # concatenate heads and put through final linear layer, reshape
+        # only copies when the SDPA output layout is not already compatible
+        concat = scores.transpose(1,2).reshape(bs, -1, self.d_model)
         output = self.out(concat)
     
         return output
@@ -146,7 +106,7 @@ class FeedForward(nn.Module):
         self.linear_2 = nn.Linear(d_ff, d_model)
     
     def forward(self, x):
-        x = self.dropout(F.relu(self.linear_1(x)))
+        x = self.dropout(F.gelu(self.linear_1(x), approximate='tanh'))
         x = self.linear_2(x)
         return x
     
@@ -226,8 +186,8 @@ class CosineWithRestarts(torch.optim.lr_scheduler._LRScheduler):
 class EncoderLayer(nn.Module):
     def __init__(self, d_model, heads, dropout=0.1):
         super().__init__()
-        self.norm_1 = Norm(d_model)
-        self.norm_2 = Norm(d_model)
+        self.norm_1 = nn.LayerNorm(d_model, eps=1e-6)
+        self.norm_2 = nn.LayerNorm(d_model, eps=1e-6)
         self.attn = MultiHeadAttention(heads, d_model, dropout=dropout)
         self.ff = FeedForward(d_model, dropout=dropout)
         self.dropout_1 = nn.Dropout(dropout)
@@ -235,7 +195,7 @@ class EncoderLayer(nn.Module):
         
     def forward(self, x, mask):
         x2 = self.norm_1(x)
-        x = x + self.dropout_1(self.attn(x2,x2,x2,mask))
+        x = x + self.dropout_1(self.attn(x2,mask))
         x2 = self.norm_2(x)
         x = x + self.dropout_2(self.ff(x2))
         return x
@@ -245,9 +205,9 @@ class EncoderLayer(nn.Module):
 class DecoderLayer(nn.Module):
     def __init__(self, d_model, heads, dropout=0.1):
         super().__init__()
-        self.norm_1 = Norm(d_model)
-        self.norm_2 = Norm(d_model)
-        self.norm_3 = Norm(d_model)
+        self.norm_1 = nn.LayerNorm(d_model, eps=1e-6)
+        self.norm_2 = nn.LayerNorm(d_model, eps=1e-6)
+        self.norm_3 = nn.LayerNorm(d_model, eps=1e-6)
         
         self.dropout_1 = nn.Dropout(dropout)
         # self.dropout_2 = nn.Dropout(dropout)
@@ -257,11 +217,11 @@ class DecoderLayer(nn.Module):
         # self.attn_2 = MultiHeadAttention(heads, d_model, dropout=dropout)
         self.ff = FeedForward(d_model, dropout=dropout)
 
-    def forward(self, x, trg_mask):
+    def forward(self, x):
         x2 = self.norm_1(x)
         # Remove the skip connection
-        # x = x + self.dropout_1(self.attn_1(x2, x2, x2, trg_mask))
-        x = self.dropout_1(self.attn_1(x2, x2, x2, trg_mask))
+        # x = x + self.dropout_1(self.attn_1(x2, is_causal=True))
+        x = self.dropout_1(self.attn_1(x2, is_causal=True))
         x2 = self.norm_2(x)
         # Cross Attention
         # x = x + self.dropout_2(self.attn_2(x2, e_outputs, e_outputs, \
@@ -270,8 +230,8 @@ class DecoderLayer(nn.Module):
         #######
         # Remove the skip connection
         # x = x + self.dropout_3(self.ff(x2))
-        x = self.dropout_1(self.attn_1(x2, x2, x2, trg_mask))
-        return x    
+        x = self.dropout_3(self.ff(x2))
+        return x
     
 class Encoder(nn.Module):
     def __init__(self, vocab_size, d_model, N, heads, dropout):
@@ -280,12 +240,15 @@ class Encoder(nn.Module):
         self.embed = Embedder(vocab_size, d_model)
         self.pe = PositionalEncoder(d_model, dropout=dropout)
         self.layers = get_clones(EncoderLayer(d_model, heads, dropout), N)
-        self.norm = Norm(d_model)
+        self.norm = nn.LayerNorm(d_model, eps=1e-6)
     def forward(self, src, mask):
         x = self.embed(src)
         x = self.pe(x)
         for i in range(self.N):
-            x = self.layers[i](x, mask)
+            if self.training:
+                x = checkpoint(self.layers[i], x, mask, use_reentrant=False)
+            else:
+                x = self.layers[i](x, mask)
         return self.norm(x)
     
 class Decoder(nn.Module):
@@ -295,28 +258,51 @@ class Decoder(nn.Module):
         self.embed = Embedder(vocab_size, d_model)
         self.pe = PositionalEncoder(d_model, dropout=dropout)
         self.layers = get_clones(DecoderLayer(d_model, heads, dropout), N)
-        self.norm = Norm(d_model)
-    def forward(self, trg, trg_mask):
+        self.norm = nn.LayerNorm(d_model, eps=1e-6)
+    def forward(self, trg):
         x = self.embed(trg)
         x = self.pe(x)
         for i in range(self.N):
-            x = self.layers[i](x, trg_mask)
+            # recompute layer activations in backward instead of storing them
+            if self.training:
+                x = checkpoint(self.layers[i], x, use_reentrant=False)
+            else:
+                x = self.layers[i](x)
         return self.norm(x)
 
 class Transformer(nn.Module):
     # Need to combine the source and the target vocab
-    def __init__(self, trg_vocab, d_model, N, heads, dropout):
+    def __init__(self, trg_vocab, d_model, N, heads, dropout, tied=True, loss_chunks=8):
         super().__init__()
+        self.loss_chunks = loss_chunks
         # remove the encoder
         # self.encoder = Encoder(src_vocab, d_model, N, heads, dropout)
         self.decoder = Decoder(trg_vocab, d_model, N, heads, dropout)
         self.out = nn.Linear(d_model, trg_vocab)
-    def forward(self, trg, trg_mask):
+        if tied:
+            # share the token embedding with the output projection
+            self.out.weight = self.decoder.embed.embed.weight
+            nn.init.zeros_(self.out.bias)
+    def forward(self, trg, targets=None):
         # e_outputs = self.encoder(src, src_mask)
         #print("DECODER")
-        d_output = self.decoder(trg, trg_mask)
-        output = self.out(d_output)
-        return output
+        d_output = self.decoder(trg)
+        if targets is None:
+            output = self.out(d_output)
+            return output
+        # when targets are given return the mean loss instead of the logits,
+        # projecting onto the vocab one chunk at a time and recomputing each
+        # chunk in backward so the full (bs * sl, vocab) logits never exist
+        hidden = d_output.reshape(-1, d_output.size(-1))
+        targets = targets.reshape(-1)
+        total = 0
+        for h, t in zip(hidden.chunk(self.loss_chunks), targets.chunk(self.loss_chunks)):
+            total = total + checkpoint(self.chunk_loss, h, t, use_reentrant=False)
+        return total / (targets != -100).sum()
+
+    def chunk_loss(self, hidden, targets):
+        output = self.out(hidden)
+        return F.cross_entropy(output, targets, ignore_index=-100, reduction='sum')
 
 def get_model(opt, trg_vocab):
     
@@ -324,7 +310,8 @@ def get_model(opt, trg_vocab):
     assert opt.dropout < 1
 
     # Modified the model parameters
-    model = Transformer(trg_vocab, opt.d_model, opt.n_layers, opt.heads, opt.dropout)
+    model = Transformer(trg_vocab, opt.d_model, opt.n_layers, opt.heads, opt.dropout, \
+                        tied=bool(opt.tied))
     model.to(opt.device)
        
     if opt.loadname is not None:
@@ -343,32 +330,31 @@ class WikiDataset(Dataset):
     def __init__(self, data, block_size):
         super(WikiDataset, self).__init__()
         self.block_size = block_size
-        self.data = [data[i:i+block_size+1] for i in range(0, len(data), block_size)]
+        self.data = np.asarray(data, dtype=np.int32)
+        # only keep full blocks of block_size+1 tokens, dropping the ragged
+        # tail so every batch has the same static shape
+        self.n_blocks = (len(self.data) - 1) // block_size
 
     def __len__(self):
-        return len(self.data)
+        return self.n_blocks
     
     def __getitem__(self, index):
-        text = torch.tensor(self.data[index], dtype=torch.long)
+        start = index * self.block_size
+        block = self.data[start:start+self.block_size+1]
+        text = torch.from_numpy(block.astype(np.int64))
         # All the text except the last token
         input_text = text[:-1]
         # All the text except the first token
         target_text = text[1:]
         return input_text, target_text
     
-# Code for batching along with the padding    
+# Code for batching, all blocks have the same length so no padding is needed
 def collate_fn(batch):
     input_text, target_text = zip(*batch)
-    inputs = pad_sequence(input_text, batch_first=True, padding_value=0)
-    # Padding value is set to be -100 so that the pad tokens are not considered 
-    # in the gradient calculation 
-    targets = pad_sequence(target_text, batch_first=True, padding_value=-100)
+    inputs = torch.stack(input_text)
+    targets = torch.stack(target_text)
     return inputs, targets
 
-def no_peak_mask(size):
-    mask = torch.triu(torch.ones(size, size) * float('-inf'), diagonal=1)
-    return mask
-
 import matplotlib.pyplot as plt
 
 def plot_metrics(training_losses, validation_losses, training_perplexities, validation_perplexities, filename='training_validation_metrics.png'):
@@ -398,30 +384,34 @@ def plot_metrics(training_losses, validation_losses, training_perplexities, vali
 
 def validate(model, valid_dataloader, loss_fn, device):
     model.eval()
-    total_loss = 0
+    total_loss = torch.zeros((), device=device)
     with torch.no_grad():
         for input_text, target_text in valid_dataloader:
-            input_text, target_text = input_text.to(device), target_text.to(device)
-            input_mask = no_peak_mask(input_text.size(1)).to(device)
-            output = model(input_text, input_mask)
-            loss = loss_fn(output.view(-1, output.size(-1)), target_text.view(-1))
-            total_loss += loss.item()
-    avg_loss = total_loss / len(valid_dataloader)
+            input_text = input_text.to(device, non_blocking=True)
+            target_text = target_text.to(device, non_blocking=True)
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16):
+                output = model(input_text)
+                # CrossEntropyLoss takes (bs, vocab, sl) logits against (bs, sl)
+                # targets directly, no flattening needed
+                loss = loss_fn(output.transpose(1,2), target_text)
+            total_loss += loss.detach()
+    avg_loss = (total_loss / len(valid_dataloader)).item()
     perplexity = math.exp(avg_loss)
     return avg_loss, perplexity
     
 def test(model, opt, test_dataloader, loss_fn):
     model.eval()
     device = opt.device
-    total_loss = 0
+    total_loss = torch.zeros((), device=device)
     with torch.no_grad():
         for input_text, target_text in test_dataloader:
-            input_text, target_text = input_text.to(device), target_text.to(device)
-            input_mask = no_peak_mask(input_text.size(1)).to(device)
-            output = model(input_text, input_mask)
-            loss = loss_fn(output.view(-1, output.size(-1)), target_text.view(-1))
-            total_loss += loss.item()
-    avg_loss = total_loss / len(test_dataloader)
+            input_text = input_text.to(device, non_blocking=True)
+            target_text = target_text.to(device, non_blocking=True)
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16):
+                output = model(input_text)
+                loss = loss_fn(output.transpose(1,2), target_text)
+            total_loss += loss.detach()
+    avg_loss = (total_loss / len(test_dataloader)).item()
     perplexity = math.exp(avg_loss)
     return avg_loss, perplexity
 
@@ -454,25 +444,29 @@ def train_model(model, opt, train_dataloader, valid_dataloader, loss_fn):
     device = opt.device
 
     optimizer = opt.optimizer
+    model.zero_grad(set_to_none=True)
 
     for epoch in range(opt.epochs):
         model.train()
-        total_tl = 0
+        # accumulate on the device so there is no GPU->CPU sync per batch
+        total_tl = torch.zeros((), device=device)
 
         for input_text, target_text in train_dataloader:
-            input_text, target_text = input_text.to(device), target_text.to(device)
-            input_mask = no_peak_mask(input_text.size(1)).to(device)
-            output = model(input_text, input_mask)
-            loss = loss_fn(output.view(-1, output.size(-1)), target_text.view(-1))
-            optimizer.zero_grad()
+            input_text = input_text.to(device, non_blocking=True)
+            target_text = target_text.to(device, non_blocking=True)
+            optimizer.zero_grad(set_to_none=True)
+            # bf16 autocast runs the matmuls on tensor cores; bf16 has the
+            # fp32 exponent range so no GradScaler is needed
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16):
+                loss = model(input_text, target_text)
             loss.backward()
             optimizer.step()
             if opt.SGDR == True:
                 opt.sched.step()
             
-            total_tl += loss.item()
+            total_tl += loss.detach()
 
-        avg_tl = total_tl / len(train_dataloader)
+        avg_tl = (total_tl / len(train_dataloader)).item()
         train_perplexity = math.exp(avg_tl)
         avg_vl, valid_perplexity = validate(model, valid_dataloader, loss_fn, device)
 
@@ -486,7 +480,8 @@ def train_model(model, opt, train_dataloader, valid_dataloader, loss_fn):
 
         if (epoch + 1) % 5 == 0:
             model_save_path = os.path.join(checkpoint_dir, f'model_epoch_{epoch+1}.pth')
-            torch.save(model.state_dict(), model_save_path)
+            # save the uncompiled module so keys have no _orig_mod. prefix
+            torch.save(getattr(model, '_orig_mod', model).state_dict(), model_save_path)
             print(f"Model saved to {model_save_path} at epoch {epoch+1}")
 
     return train_losses, train_perplexities, valid_losses, valid_perplexities
@@ -532,6 +527,10 @@ def main():
     if opt.device == 0:
         assert torch.cuda.is_available()
     opt.device = torch.device("cuda:0")
+    # allow TF32 for the fp32 matmuls left outside autocast
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.set_float32_matmul_precision('high')
+    torch.backends.cudnn.benchmark = True
     
     time_name = time.strftime("%y%m%d_%H%M%S")
     opt.time_name = time_name
@@ -562,13 +561,16 @@ def main():
     # Need a single vocab size
     model = get_model(opt,opt.vocab_size)
     model = model.to(opt.device)
+    # fuse the decoder's small ops into Inductor/Triton kernels
+    model = torch.compile(model, mode='max-autotune')
         
     model_parameters = filter(lambda p: p.requires_grad, model.parameters())
     params = sum([np.prod(p.size()) for p in model_parameters])        
     text = 'total params: %d' % (params)
     print(text)
 
-    opt.optimizer = torch.optim.Adam(model.parameters(), lr=opt.lr, betas=(0.9, 0.98), eps=1e-9)
+    # fused=True runs the update for all parameters in a single kernel
+    opt.optimizer = torch.optim.AdamW(model.parameters(), lr=opt.lr, betas=(0.9, 0.98), eps=1e-9, fused=True)
     if opt.SGDR == True:
         opt.sched = CosineWithRestarts(opt.optimizer, T_max=opt.train_len)
 
@@ -584,15 +586,18 @@ def main():
     # Code goes here
     # Train Dataloader
     train_dataset = WikiDataset(opt.train, block_size=opt.seqlen)
-    train_dataloader = DataLoader(train_dataset, batch_size=opt.batchsize, shuffle=True, collate_fn=collate_fn)
+    train_dataloader = DataLoader(train_dataset, batch_size=opt.batchsize, shuffle=True, collate_fn=collate_fn, \
+                                  num_workers=4, pin_memory=True, persistent_workers=True)
 
     # Valid Dataloader
     valid_dataset = WikiDataset(opt.valid, block_size=opt.seqlen)
-    valid_dataloader = DataLoader(valid_dataset, batch_size=opt.batchsize, shuffle=True, collate_fn=collate_fn)
+    valid_dataloader = DataLoader(valid_dataset, batch_size=opt.batchsize, shuffle=True, collate_fn=collate_fn, \
+                                  num_workers=4, pin_memory=True, persistent_workers=True)
 
     # Test Dataloader
     test_dataset = WikiDataset(opt.test, block_size=opt.seqlen)
-    test_dataloader = DataLoader(test_dataset, batch_size=opt.batchsize, shuffle=True, collate_fn=collate_fn)
+    test_dataloader = DataLoader(test_dataset, batch_size=opt.batchsize, shuffle=True, collate_fn=collate_fn, \
+                                 num_workers=4, pin_memory=True, persistent_workers=True)
 
     # optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
     loss_fn = nn.CrossEntropyLoss(ignore_index=-100)